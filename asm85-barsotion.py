@@ -1,7 +1,15 @@
 # #!python3
 
 import argparse
+import io
+import json
+import os
 import struct
+import sys
+try:
+    import resource
+except ImportError:
+    resource = None
 
 DESCRIPTION = "Intel 8080/8085 assembler. All of the commands of 8085 are supported, including undocumented instructions such as 'DSUB', 'ARHL', 'RDEL', 'LDHI', LDSI', 'RSTV', 'SHLX', 'LHLX', 'JNX5'('JNK'), 'JX5'('JK')."
 
@@ -55,10 +63,83 @@ def createParser():
         default = False,
         help = "Disable undocumented 8085 instructions."
     )
+    parser.add_argument(
+        "-V",
+        "--variants",
+        dest = "variants",
+        default = None,
+        help = f"Comma-separated target profiles ({', '.join(Profiles)}) built from one parse. Output files get the profile name as suffix."
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-going",
+        dest = "keep_going",
+        action = 'store_true',
+        default = False,
+        help = "Report all errors instead of stopping at the first one."
+    )
+    parser.add_argument(
+        "--diag-json",
+        dest = "diag_json_filename",
+        default = None,
+        help = f"Write diagnostics as JSON ('-' for stdout)."
+    )
+    parser.add_argument(
+        "-z",
+        "--lz",
+        dest = "lz_filename",
+        default = None,
+        help = f"Compressed self-extracting image target: decompressor, header and LZ-packed code."
+    )
+    parser.add_argument(
+        "--lz-load",
+        dest = "lz_loadaddr",
+        default = None,
+        help = f"Load address of the compressed image, right after the code by default."
+    )
+    parser.add_argument(
+        "--stream",
+        dest = "stream",
+        action = 'store_true',
+        default = False,
+        help = "Re-read the source on each pass and write output files as code is generated, so memory use does not grow with the source size."
+    )
     
     return parser
 
 
+"""
+Target profiles: (only_8080, only_8085)
+"""
+Profiles = {
+    '8080'        : (True, False),
+    '8085'        : (False, False),
+    '8085-dis-ui' : (False, True),
+}
+
+
+def variant_filename(filename, variant):
+    if filename == None or variant == None:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f'{root}-{variant}{ext}'
+
+
+def diag_filename(filename, variant):
+    if filename == '-':
+        return filename
+    return variant_filename(filename, variant)
+
+
+def peak_rss_kib():
+    if resource == None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
 Instructions = {
     'MOV'   : 0,
     'MVI'   : 1,
@@ -315,7 +396,7 @@ def reg8_to_code(reg):
     elif reg == 'A':
         code = 0b111
     else:
-        raise Exception("Incorrect 8-bit register argument")
+        raise AsmError('REG', "Incorrect 8-bit register argument", reg)
     return code
 
 
@@ -331,7 +412,7 @@ def reg16_sp_to_code(reg):
     elif reg == 'SP':
         code = 0b11
     else:
-        raise Exception("Incorrect 16-bit (SP-capable) register argument")
+        raise AsmError('REG', "Incorrect 16-bit (SP-capable) register argument", reg)
     return code
 
 
@@ -347,10 +428,144 @@ def reg16_psw_to_code(reg):
     elif reg == 'PSW':
         code = 0b11
     else:
-        raise Exception("Incorrect 16-bit (PSW-capable) register argument")
+        raise AsmError('REG', "Incorrect 16-bit (PSW-capable) register argument", reg)
     return code
 
 
+"""
+Diagnostic codes:
+ARG     - missing or extra argument
+REG     - incorrect register argument
+NUMBER  - incorrect number constant
+RANGE   - value does not fit into the argument
+UNDEF   - undefined name
+UNKNOWN - unknown instruction
+TARGET  - instruction is not supported by the target profile
+INCLUDE - included file cannot be opened
+PHASE   - included file address differs between passes (stops translation)
+MEMORY  - end of addressable memory reached (stops translation)
+ERROR   - any other error
+"""
+class AsmError(Exception):
+
+    def __init__(self, code, message, token=None, fatal=False):
+        super().__init__(message)
+        self.code = code
+        self.token = token
+        self.fatal = fatal
+
+
+def statement_size(instruction, arg1):
+    instruction = instruction.upper()
+    if instruction == '.DB':
+        return 1
+    if instruction == '.DW':
+        return 2
+    if instruction == '.DS':
+        if arg1 == None:
+            return 0
+        return len(arg1)
+    instruction_number = Instructions.get(instruction)
+    if instruction_number == None:
+        return 0
+    instruction_type = Types[instruction_number]
+    if instruction_type == TYPE_ADI or instruction_type == TYPE_MVI:
+        return 2
+    if instruction_type == TYPE_JMP or instruction_type == TYPE_LXI:
+        return 3
+    return 1
+
+
+class SourceStream:
+
+    def __init__(self, translator, filename):
+        self.translator = translator
+        self.filename = filename
+
+    def __iter__(self):
+        return self.translator.read_source(self.filename)
+
+
+"""
+LZ packed stream (see lz85.asm):
+0x00       - end of stream
+0x01..0x7F - literal run, followed by that many bytes
+0x80..0xFF - copy of (token & 0x7F) + LZ_MIN_MATCH bytes, followed by
+             16-bit distance back from the output pointer
+T-states are those of the lz85.asm decompressor on 8085.
+"""
+LZ_MIN_MATCH = 4
+LZ_MAX_MATCH = 0x7F + LZ_MIN_MATCH
+LZ_MAX_LITERALS = 0x7F
+LZ_CHAIN_DEPTH = 16
+LZ_STUB_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lz85.asm')
+
+LZ_T_SETUP = 98
+LZ_T_END = 29
+LZ_T_LITERALS = 41
+LZ_T_MATCH = 126
+LZ_T_BYTE = 40
+
+
+def lz_flush_literals(packed, data, start, end):
+    while start < end:
+        count = min(end - start, LZ_MAX_LITERALS)
+        packed.append(count)
+        packed += data[start:start+count]
+        start += count
+
+
+def lz_compress(data):
+    packed = bytearray()
+    chains = dict()
+    literals_start = 0
+    pos = 0
+    while pos < len(data):
+        best_len = 0
+        best_dist = 0
+        chain = chains.get(data[pos:pos+LZ_MIN_MATCH])
+        if chain != None:
+            limit = min(LZ_MAX_MATCH, len(data) - pos)
+            for cand in reversed(chain[-LZ_CHAIN_DEPTH:]):
+                length = LZ_MIN_MATCH
+                while length < limit and data[cand+length] == data[pos+length]:
+                    length += 1
+                if length > best_len:
+                    best_len = length
+                    best_dist = pos - cand
+                    if length == limit:
+                        break
+        end = pos + 1
+        if best_len > 0:
+            lz_flush_literals(packed, data, literals_start, pos)
+            packed.append(0x80 | (best_len - LZ_MIN_MATCH))
+            packed += struct.pack('<H', best_dist)
+            end = pos + best_len
+        while pos < end:
+            if pos + LZ_MIN_MATCH <= len(data):
+                chains.setdefault(data[pos:pos+LZ_MIN_MATCH], []).append(pos)
+            pos += 1
+        if best_len > 0:
+            literals_start = pos
+    lz_flush_literals(packed, data, literals_start, len(data))
+    packed.append(0)
+    return bytes(packed)
+
+
+def lz_tstates(packed):
+    tstates = LZ_T_SETUP + LZ_T_END
+    pos = 0
+    while packed[pos] != 0:
+        token = packed[pos]
+        if token < 0x80:
+            tstates += LZ_T_LITERALS + LZ_T_BYTE * token
+            pos += 1 + token
+        else:
+            tstates += LZ_T_MATCH + LZ_T_BYTE * ((token & 0x7F) + LZ_MIN_MATCH)
+            pos += 3
+    return tstates
+
+
     
 
 
@@ -359,55 +574,156 @@ class trans:
 
     def __init__(self):
     
+        self.failed = False
+        self.variant = None
+        self.stdout_diagnostics = None
+        self.json_stdout = sys.stdout
         parser = createParser()
         namespace = parser.parse_args()
+        if namespace.diag_json_filename == '-':
+            # stdout holds only the JSON document, everything else goes to stderr
+            self.stdout_diagnostics = []
+            sys.stdout = sys.stderr
         if not namespace.startaddr[0].isdigit():
             raise Exception('Incorrect start address')
         startaddr = self.auto_decode_number(namespace.startaddr)
+        lz_loadaddr = None
+        if namespace.lz_loadaddr != None:
+            if not namespace.lz_loadaddr[0].isdigit():
+                raise Exception('Incorrect load address')
+            lz_loadaddr = self.auto_decode_number(namespace.lz_loadaddr)
+        
+        variants = [(None, namespace.only_8080, namespace.only_8085)]
+        if namespace.variants != None:
+            if namespace.only_8080 or namespace.only_8085:
+                raise Exception('--8080 and --dis-ui cannot be combined with --variants, use profiles instead')
+            variants = []
+            for variant in namespace.variants.split(','):
+                variant = variant.strip()
+                if Profiles.get(variant) == None:
+                    raise Exception(f'Unknown target profile: {variant}')
+                variants.append((variant,) + Profiles.get(variant))
         
-        self.only_8080 = namespace.only_8080
-        self.only_8085 = namespace.only_8085
+        self.only_8080 = False
+        self.only_8085 = False
+        self.keep_going = namespace.keep_going
+        self.stream = namespace.stream
         
+        self.diagnostics = []
         self.name_list = dict()
-        self.output_binary = bytes([])
-        self.processed_asm = ''
+        self.checkpoints = []
+        self.output_binary = io.BytesIO()
+        self.processed_asm = io.StringIO()
         self.binary_write_enable = False
         self.processed_write_enable = False
         
+        if not os.path.isfile(namespace.input_filename):
+            print(f'Cannot open input file "{namespace.input_filename}"')
+            self.failed = True
+            return
+        # The source is re-read on each pass; only several variants
+        # share one parse, unless memory is to stay bounded
+        source = SourceStream(self, namespace.input_filename)
+        if len(variants) > 1 and not self.stream:
+            print('Parse source...')
+            source = list(source)
+        # Layout does not depend on the target profile, so names are
+        # resolved once with all instructions allowed
         print('Get names values...')
-        end, error = self.translate(namespace.input_filename, startaddr)
-        if error:
+        end, error = self.translate(source, startaddr)
+        if error and not self.keep_going:
+            self.failed = True
+            self.report_diagnostics()
+            if namespace.diag_json_filename == '-':
+                self.write_diagnostics('-')
+            else:
+                for variant, only_8080, only_8085 in variants:
+                    self.write_diagnostics(diag_filename(namespace.diag_json_filename, variant))
             return
         print(f'End at {hex(end)}')
-        self.binary_write_enable = True
-        if namespace.processed_asm_filename != None:
-            self.processed_write_enable = True
-        print('Generate code...')
-        end, error = self.translate(namespace.input_filename, startaddr)
-        if error:
-            return
-        #print(self.output_binary)
-        print('Saving...')
-        with open(namespace.output_filename, 'wb') as f:
-            f.write(self.output_binary)
-        if namespace.names_filename != None:
+        built = 0
+        for variant, only_8080, only_8085 in variants:
+            self.variant = variant
+            if variant != None:
+                print(f'Variant {variant}:')
+            self.only_8080 = only_8080
+            self.only_8085 = only_8085
+            output_filename = variant_filename(namespace.output_filename, variant)
+            processed_asm_filename = variant_filename(namespace.processed_asm_filename, variant)
+            self.binary_write_enable = True
+            if namespace.processed_asm_filename != None:
+                self.processed_write_enable = True
+            self.output_binary = io.BytesIO()
+            self.processed_asm = io.StringIO()
+            if self.stream:
+                self.output_binary = open(output_filename, 'wb')
+                if self.processed_write_enable:
+                    self.processed_asm = open(processed_asm_filename, 'w')
+            self.diagnostics = []
+            print('Generate code...')
+            error = True
+            try:
+                end, error = self.translate(source, startaddr)
+            finally:
+                # Also cleans up when re-reading the source fails
+                if self.stream:
+                    self.output_binary.close()
+                    self.processed_asm.close()
+                    if error:
+                        os.remove(output_filename)
+                        if self.processed_write_enable:
+                            os.remove(processed_asm_filename)
+            self.report_diagnostics()
+            self.write_diagnostics(diag_filename(namespace.diag_json_filename, variant))
+            if error:
+                self.failed = True
+                continue
+            built += 1
+            if not self.stream:
+                #print(self.output_binary)
+                print('Saving...')
+                with open(output_filename, 'wb') as f:
+                    f.write(self.output_binary.getvalue())
+                if self.processed_write_enable:
+                    print('Write processed assembly file...')
+                    with open(processed_asm_filename, 'w') as f:
+                        f.write(self.processed_asm.getvalue())
+            if namespace.lz_filename != None:
+                print('Write compressed image...')
+                if self.stream:
+                    # The image is at most 64 KiB
+                    with open(output_filename, 'rb') as f:
+                        image = f.read()
+                else:
+                    image = self.output_binary.getvalue()
+                self.write_lz(variant_filename(namespace.lz_filename, variant), image, startaddr, lz_loadaddr)
+        if built > 0 and namespace.names_filename != None:
             print('Write names file...')
             keys = list(self.name_list.keys())
             with open(namespace.names_filename, 'w') as f:
                 for name in keys:
                     f.write(f'{name}  {hex(self.name_list.get(name))}\n')
-        if self.processed_write_enable:
-            print('Write processed assembly file...')
-            with open(namespace.processed_asm_filename, 'w') as f:
-                f.write(self.processed_asm)
+        if self.stream:
+            rss = peak_rss_kib()
+            if rss == None:
+                print('Peak RSS: unavailable')
+            else:
+                print(f'Peak RSS: {rss} KiB')
         
     
     def auto_decode_number(self, s):
+        try:
+            return self.decode_number(s)
+        except ValueError:
+            raise AsmError('NUMBER', f'Incorrect number constant: {s}', s)
+    
+    
+    def decode_number(self, s):
         val = None
         if s[0].isdigit() or s[0] == '$':
             if s[0] == '$':
                 if len(s) == 1:
-                    raise Exception(f'Incorrect number constant: {s}')
+                    raise AsmError('NUMBER', f'Incorrect number constant: {s}', s)
                 else:
                     val = int(s[1:], 16)
         
@@ -416,19 +732,19 @@ class trans:
                 
             elif s[:2] == '0x':
                 if len(s) == 2:
-                    raise Exception(f'Incorrect number constant: {s}')
+                    raise AsmError('NUMBER', f'Incorrect number constant: {s}', s)
                 else:
                     val = int(s, 16)
             
             elif s[:2] == '0b':
                 if len(s) == 2:
-                    raise Exception(f'Incorrect number constant: {s}')
+                    raise AsmError('NUMBER', f'Incorrect number constant: {s}', s)
                 else:
                     val = int(s, 2)
             
             elif s[:2] == '0o':
                 if len(s) == 2:
-                    raise Exception(f'Incorrect number constant: {s}')
+                    raise AsmError('NUMBER', f'Incorrect number constant: {s}', s)
                 else:
                     val = int(s, 8)
             
@@ -445,97 +761,97 @@ class trans:
                 val = self.name_list.get(s)
             if val == None:
                 if self.binary_write_enable:
-                    raise Exception("Undefined constant: {s}")
+                    raise AsmError('UNDEF', f'Undefined constant: {s}', s)
                 val = 0
         return val
         
         
     def form_opcode(self, instruction, arg1, arg2):
         instruction_number = Instructions.get(instruction)
+        if instruction_number == None:
+            return None, None, None
         if self.only_8080:
             if instruction_number > 77:
-                raise Exception(f'Unsupported instruction for 8080: {instruction}')
+                raise AsmError('TARGET', f'Unsupported instruction for 8080: {instruction}')
         if self.only_8085:
             if instruction_number > 79:
-                raise Exception(f'Undocumented 8085 instructions are disabled: {instruction}')
-        if instruction_number == None:
-            return None, None, None
+                raise AsmError('TARGET', f'Undocumented 8085 instructions are disabled: {instruction}')
         opcode = Opcodes[instruction_number]
         opcode1 = None
         opcode2 = None
         instruction_type = Types[instruction_number]
         if instruction_type == TYPE_NOP:
             if arg1 != None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
                 
         elif instruction_type == TYPE_MOV:
             if arg1 == None or arg2 == None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode += reg8_to_code(arg1) * 8
             opcode += reg8_to_code(arg2)
             
         elif instruction_type == TYPE_ADD:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode += reg8_to_code(arg1)
             
         elif instruction_type == TYPE_INR:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode += reg8_to_code(arg1) * 8
             
         elif instruction_type == TYPE_ADI:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode1 = self.auto_decode_number(arg1)
             if opcode1 > 255:
-                raise Exception(f'Too big value in argument: {opcode1}')
+                raise AsmError('RANGE', f'Too big value in argument: {opcode1}', arg1)
             
         elif instruction_type == TYPE_MVI:
             if arg1 == None or arg2 == None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode += reg8_to_code(arg1) * 8
             opcode1 = self.auto_decode_number(arg2)
             if opcode1 > 255:
-                raise Exception(f'Too big value in argument: {opcode1}')
+                raise AsmError('RANGE', f'Too big value in argument: {opcode1}', arg2)
             
         elif instruction_type == TYPE_JMP:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             val = self.auto_decode_number(arg1)
             if val > 65535:
-                raise Exception(f'Too big value in argument: {opcode1}')
+                raise AsmError('RANGE', f'Too big value in argument: {val}', arg1)
             opcode1 = val %  256
             opcode2 = val // 256
             
         elif instruction_type == TYPE_DAD:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             if instruction == 'LDAX' or instruction == 'STAX':
                 if arg1.upper() != 'B' and arg1.upper() != 'D':
-                    raise Exception('Argument error: {arg1} with {instruction}')
+                    raise AsmError('ARG', f'Argument error: {arg1} with {instruction}', arg1)
             opcode += reg16_sp_to_code(arg1) * 16
             
         elif instruction_type == TYPE_POP:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode += reg16_psw_to_code(arg1) * 16
             
         elif instruction_type == TYPE_LXI:
             if arg1 == None or arg2 == None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             opcode += reg16_sp_to_code(arg1) * 16
             val = self.auto_decode_number(arg2)
             if val > 65535:
-                raise Exception(f'Too big value in argument: {val}')
+                raise AsmError('RANGE', f'Too big value in argument: {val}', arg2)
             opcode1 = val %  256
             opcode2 = val // 256
         elif instruction_type == TYPE_RST:
             if arg1 == None or arg2 != None:
-                raise Exception('Argument error')
+                raise AsmError('ARG', 'Argument error')
             val = self.auto_decode_number(arg1)
             if val > 7:
-                raise Exception(f'Too big value in argument: {val}')
+                raise AsmError('RANGE', f'Too big value in argument: {val}', arg1)
         else:
             raise Exception("Critical: incorrect instruction type")
         
@@ -601,11 +917,11 @@ class trans:
     
     def statement_to_processed(self, statement, instruction_cnt, instruction, o, o1, o2):
         if instruction == None:
-            self.processed_asm += '             ' + statement
+            self.processed_asm.write('             ' + statement)
         elif instruction[-1] == ':':
-            self.processed_asm += statement
+            self.processed_asm.write(statement)
         elif instruction.upper() == '.INCLUDE' or instruction.upper() == '.DEF' or instruction.upper() == '.EQU' or instruction.upper() == '.ORG':
-            self.processed_asm += statement
+            self.processed_asm.write(statement)
         else:
             if o2 != None:
                 instruction_cnt -= 3
@@ -618,107 +934,237 @@ class trans:
             #    self.processed_asm += self.int_to_hex4(instruction_cnt+1) + ' ' + self.int_to_hex2(o1) + '\n'
             #if o2 != None:
             #    self.processed_asm += self.int_to_hex4(instruction_cnt+2) + ' ' + self.int_to_hex2(o2) + '\n'
-            self.processed_asm += self.int_to_hex4(instruction_cnt) + ' ' + self.int_to_hex2(o)# + '  ' + statement
+            self.processed_asm.write(self.int_to_hex4(instruction_cnt) + ' ' + self.int_to_hex2(o))# + '  ' + statement
             if o1 != None:
-                self.processed_asm += self.int_to_hex2(o1)
+                self.processed_asm.write(self.int_to_hex2(o1))
             else:
-                self.processed_asm += '  '
+                self.processed_asm.write('  ')
             if o2 != None:
-                self.processed_asm += self.int_to_hex2(o2)
+                self.processed_asm.write(self.int_to_hex2(o2))
             else:
-                self.processed_asm += '  '
-            self.processed_asm += '  ' + statement
+                self.processed_asm.write('  ')
+            self.processed_asm.write('  ' + statement)
     
 
-    def translate(self, filename, instruction_cnt):
+    def read_source(self, filename):
         with open(filename, 'r') as input_f:
             statement_cnt = 0
+            for statement in input_f:
+                statement_cnt += 1
+                instruction, arg1, arg2 = self.decode_statement(statement[:-1])
+                yield filename, statement_cnt, statement, instruction, arg1, arg2
+                if instruction != None and instruction.upper() == '.INCLUDE' and arg1 != None:
+                    if os.path.isfile(arg1[1:-1]):
+                        yield from self.read_source(arg1[1:-1])
+    
+
+    def translate(self, source, instruction_cnt):
+        error = False
+        checkpoint_cnt = 0
+        if not self.binary_write_enable:
+            self.checkpoints = []
+        for filename, statement_cnt, statement, instruction, arg1, arg2 in source:
+            statement_start = instruction_cnt
             try:
-                for statement in input_f:
-                    statement_cnt += 1;
-                    instruction, arg1, arg2 = self.decode_statement(statement[:-1])
-                    o = 0
-                    o1 = 0
-                    o2 = 0
-                    if instruction == None:
-                        if self.processed_write_enable:
-                            self.processed_asm += '\n'
-                        continue
-                    if instruction[-1] == ':':
-                        self.name_list[instruction[:-1]] = instruction_cnt
-                    elif instruction[0] == '.':
-                        if instruction.upper() == '.INCLUDE':
-                            if arg1 == None:
-                                raise Exception('Argument error')
-                            subfile = arg1[1:-1]
-                            instruction_cnt, error = self.translate(subfile, instruction_cnt)
-                            if error:
-                                return instruction_cnt, True
-                        elif instruction.upper() == '.DB':
-                            if arg1 == None:
-                                raise Exception('Argument error')
-                            instruction_cnt += 1
-                            val = self.auto_decode_number(arg1)
-                            if val > 255:
-                                raise Exception('Too big value in argument')
-                            o = val
-                            o1 = None
-                            o2 = None
-                            if self.binary_write_enable:
-                                self.output_binary += struct.pack('B', val)
-                        elif instruction.upper() == '.DW':
-                            if arg1 == None:
-                                raise Exception('Argument error')
-                            instruction_cnt += 2
-                            val = self.auto_decode_number(arg1)
-                            if val > 65535:
-                                raise Exception('Too big value in argument')
-                            o = val % 256
-                            o1 = val // 256
-                            o2 = None
-                            if self.binary_write_enable:
-                                self.output_binary += struct.pack('h', val)
-                        elif instruction.upper() == '.DS':
-                            if arg1 == None:
-                                raise Exception('Argument error')
-                            instruction_cnt += len(arg1)
-                            if self.binary_write_enable:
-                                self.output_binary += bytes(arg1, 'windows-1251')
-                        elif instruction.upper() == '.EQU':
-                            if arg1 == None or arg2 == None:
-                                raise Exception('Argument error')
-                            self.name_list[arg1] = self.auto_decode_number(arg2)
+                o = 0
+                o1 = 0
+                o2 = 0
+                if instruction == None:
+                    if self.processed_write_enable:
+                        self.processed_asm.write('\n')
+                    continue
+                if instruction[-1] == ':':
+                    self.name_list[instruction[:-1]] = instruction_cnt
+                elif instruction[0] == '.':
+                    if instruction.upper() == '.INCLUDE':
+                        if arg1 == None:
+                            raise AsmError('ARG', 'Argument error')
+                        if not os.path.isfile(arg1[1:-1]):
+                            raise AsmError('INCLUDE', f'Cannot open included file: {arg1}', arg1)
+                        if not self.binary_write_enable:
+                            self.checkpoints.append(instruction_cnt)
+                        elif checkpoint_cnt >= len(self.checkpoints) or self.checkpoints[checkpoint_cnt] != instruction_cnt:
+                            raise AsmError('PHASE', f'Included file address differs between passes: {arg1}', arg1, fatal=True)
+                        checkpoint_cnt += 1
+                    elif instruction.upper() == '.DB':
+                        if arg1 == None:
+                            raise AsmError('ARG', 'Argument error')
+                        instruction_cnt += 1
+                        val = self.auto_decode_number(arg1)
+                        if val > 255:
+                            raise AsmError('RANGE', 'Too big value in argument', arg1)
+                        o = val
+                        o1 = None
+                        o2 = None
+                        if self.binary_write_enable:
+                            self.output_binary.write(struct.pack('B', val))
+                    elif instruction.upper() == '.DW':
+                        if arg1 == None:
+                            raise AsmError('ARG', 'Argument error')
+                        instruction_cnt += 2
+                        val = self.auto_decode_number(arg1)
+                        if val > 65535:
+                            raise AsmError('RANGE', 'Too big value in argument', arg1)
+                        o = val % 256
+                        o1 = val // 256
+                        o2 = None
+                        if self.binary_write_enable:
+                            self.output_binary.write(struct.pack('h', val))
+                    elif instruction.upper() == '.DS':
+                        if arg1 == None:
+                            raise AsmError('ARG', 'Argument error')
+                        instruction_cnt += len(arg1)
+                        if self.binary_write_enable:
+                            self.output_binary.write(bytes(arg1, 'windows-1251'))
+                    elif instruction.upper() == '.EQU':
+                        if arg1 == None or arg2 == None:
+                            raise AsmError('ARG', 'Argument error')
+                        self.name_list[arg1] = self.auto_decode_number(arg2)
                         
-                    else:
-                        o, o1, o2 = self.form_opcode(instruction.upper(), arg1, arg2)
-                        if o == None:
-                            raise Exception(f'Unknown instruction: "{instruction}"')
+                else:
+                    o, o1, o2 = self.form_opcode(instruction.upper(), arg1, arg2)
+                    if o == None:
+                        raise AsmError('UNKNOWN', f'Unknown instruction: "{instruction}"')
                             
+                    if instruction_cnt + statement_size(instruction, arg1) > 65536:
+                        raise AsmError('MEMORY', 'End of addressable memory reached', fatal=True)
+                    instruction_cnt += 1
+                    if self.binary_write_enable:
+                        self.output_binary.write(struct.pack('B', o))
+                    if o1 != None:
                         instruction_cnt += 1
                         if self.binary_write_enable:
-                            self.output_binary += struct.pack('B', o)
-                        if o1 != None:
-                            instruction_cnt += 1
-                            if self.binary_write_enable:
-                                self.output_binary += struct.pack('B', o1)
-                        if o2 != None:
-                            instruction_cnt += 1
-                            if self.binary_write_enable:
-                                self.output_binary += struct.pack('B', o2)
-                        if instruction_cnt > 65536:
-                            raise Exception('End of addressable memory reached')
+                            self.output_binary.write(struct.pack('B', o1))
+                    if o2 != None:
+                        instruction_cnt += 1
+                        if self.binary_write_enable:
+                            self.output_binary.write(struct.pack('B', o2))
                     
-                    if self.processed_write_enable:
-                        self.statement_to_processed(statement, instruction_cnt, instruction, o, o1, o2)
+                if self.processed_write_enable:
+                    self.statement_to_processed(statement, instruction_cnt, instruction, o, o1, o2)
                         
             except Exception as e:
-                print(f'An error occured in file "{filename}": {e}')
-                print(f'{statement_cnt}: "{statement[:-1]}"')
-                return instruction_cnt, True
-        return instruction_cnt, False
+                self.diagnose(filename, statement_cnt, statement, e)
+                error = True
+                if not self.keep_going or (isinstance(e, AsmError) and e.fatal):
+                    return instruction_cnt, True
+                # Placeholder keeps addresses of the following statements
+                size = statement_size(instruction, arg1)
+                instruction_cnt = statement_start + size
+                if self.binary_write_enable:
+                    self.output_binary.write(bytes(size))
+                if instruction.upper() == '.EQU' and arg1 != None and self.name_list.get(arg1) == None:
+                    self.name_list[arg1] = 0
+        return instruction_cnt, error
+    
+    
+    def diagnose(self, filename, statement_cnt, statement, e):
+        code = 'ERROR'
+        token = None
+        if isinstance(e, AsmError):
+            code = e.code
+            token = e.token
+        text = statement.rstrip('\n')
+        # Errors without a token point to the mnemonic, the others to
+        # the argument they were raised for
+        instruction, arg1, arg2 = self.decode_statement(text)
+        idx = text.find(instruction)
+        column = idx + 1
+        idx += len(instruction)
+        for arg in (arg1, arg2):
+            if arg == None or token == None:
+                break
+            idx = text.find(arg, idx)
+            if arg.upper() == token.upper():
+                column = idx + 1
+                break
+            idx += len(arg)
+        self.diagnostics.append({
+            'file'    : filename,
+            'line'    : statement_cnt,
+            'column'  : column,
+            'code'    : code,
+            'message' : str(e),
+            'text'    : text,
+            'variant' : self.variant,
+        })
+    
+    
+    def report_diagnostics(self):
+        for d in self.diagnostics:
+            print(f'An error occured in file "{d["file"]}": {d["message"]}')
+            print(f'{d["line"]}:{d["column"]}: "{d["text"]}"')
+        if len(self.diagnostics) > 1:
+            print(f'{len(self.diagnostics)} errors')
+    
+    
+    def write_diagnostics(self, json_filename):
+        if json_filename == None:
+            return
+        if json_filename == '-':
+            self.stdout_diagnostics += self.diagnostics
+        else:
+            with open(json_filename, 'w') as f:
+                json.dump(self.diagnostics, f, indent=2)
+    
+    
+    def write_stdout_diagnostics(self):
+        if self.stdout_diagnostics == None:
+            return
+        sys.stdout = self.json_stdout
+        print(json.dumps(self.stdout_diagnostics, indent=2))
+    
+    
+    def assemble(self, filename, startaddr):
+        self.name_list = dict()
+        self.output_binary = io.BytesIO()
+        self.processed_asm = io.StringIO()
+        self.binary_write_enable = False
+        self.processed_write_enable = False
+        self.diagnostics = []
+        source = list(self.read_source(filename))
+        end, error = self.translate(source, startaddr)
+        if not error:
+            self.binary_write_enable = True
+            end, error = self.translate(source, startaddr)
+        if error:
+            self.report_diagnostics()
+        return self.output_binary.getvalue(), error
+    
+    
+    def write_lz(self, filename, image, startaddr, loadaddr):
+        if loadaddr == None:
+            loadaddr = startaddr + len(image)
+        packed = lz_compress(image)
+        name_list = self.name_list
+        checkpoints = self.checkpoints
+        stub, error = self.assemble(LZ_STUB_FILENAME, loadaddr)
+        self.name_list = name_list
+        self.checkpoints = checkpoints
+        if error:
+            self.failed = True
+            return
+        size = len(stub) + 8 + len(packed)
+        if loadaddr + size > 65536:
+            print(f'Compressed image does not fit into memory at {hex(loadaddr)}')
+            self.failed = True
+            return
+        if loadaddr < startaddr + len(image) and startaddr < loadaddr + size:
+            print(f'Compressed image at {hex(loadaddr)} overlaps the code')
+            self.failed = True
+            return
+        with open(filename, 'wb') as f:
+            f.write(stub)
+            f.write(struct.pack('<HHHH', startaddr, startaddr, len(image), len(packed)))
+            f.write(packed)
+        print(f'Packed {len(image)} -> {len(packed)} bytes ({100 * len(packed) / max(len(image), 1):.1f}%), image {size} bytes at {hex(loadaddr)}')
+        print(f'Estimated unpacking time: {lz_tstates(packed)} T-states')
             
 
 translator = trans()
+translator.write_stdout_diagnostics()
+if translator.failed:
+    sys.exit(1)
 
 
 
@@ -0,0 +1,63 @@
+; LZ decompressor stub for compressed images (--lz option).
+; The stub is followed by the header and the packed stream:
+;   destination, entry point, unpacked size, packed size (16-bit words)
+; Packed stream tokens:
+;   00H       - end of stream
+;   01H..7FH  - literal run, followed by that many bytes
+;   80H..FFH  - copy (token & 7FH) + 4 bytes from the distance given
+;               by the next 16-bit word back from the output pointer
+; Unpacks the stream to the destination and returns to the entry point.
+LZ_START:
+    LXI H,LZ_HEADER
+    MOV E,M
+    INX H
+    MOV D,M
+    INX H
+    MOV C,M
+    INX H
+    MOV B,M
+    INX H
+    INX H
+    INX H
+    INX H
+    INX H
+    PUSH B
+LZ_TOKEN:
+    MOV A,M
+    INX H
+    ORA A
+    RZ
+    JM LZ_REF
+    MOV C,A
+LZ_LIT:
+    MOV A,M
+    STAX D
+    INX H
+    INX D
+    DCR C
+    JNZ LZ_LIT
+    JMP LZ_TOKEN
+LZ_REF:
+    ANI 0x7F
+    ADI 4
+    MOV C,A
+    MOV A,E
+    SUB M
+    INX H
+    MOV B,A
+    MOV A,D
+    SBB M
+    INX H
+    PUSH H
+    MOV H,A
+    MOV L,B
+LZ_COPY:
+    MOV A,M
+    STAX D
+    INX H
+    INX D
+    DCR C
+    JNZ LZ_COPY
+    POP H
+    JMP LZ_TOKEN
+LZ_HEADER: